@@ -29,7 +29,7 @@ class Qbert():
     The Qbert client to Platform9's Managed Kubernetes product.
     """
 
-    def __init__(self, token, api_url, **http_args):
+    def __init__(self, token, api_url, rate_limiter=None, **http_args):
         if not (token and api_url):
             raise ValueError('need a keystone token and API url')
         if api_url[-1] == '/':
@@ -37,14 +37,17 @@ class Qbert():
         self.api_url = api_url
         self.token = token
         self.http_args = http_args
-        session = request_utils.session_with_retries(self.api_url)
+        self.rate_limiter = rate_limiter
+        session = request_utils.session_with_retries(self.api_url,
+                                                     rate_limiter=rate_limiter)
         session.headers = {'X-Auth-Token': self.token,
                            'Content-Type': 'application/json'}
         self.session = session
 
     def _make_req(self, endpoint, method='GET', body={}, **kwargs):
         return request_utils.make_req(self.session, self.api_url + endpoint,
-                                      method, body, **kwargs)
+                                      method, body,
+                                      rate_limiter=self.rate_limiter, **kwargs)
 
     def get_cloud_provider(self, uuid):
         """
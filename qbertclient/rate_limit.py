@@ -0,0 +1,289 @@
+#  Copyright 2019 Platform9
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+Client-side adaptive rate limiting for requests sent to the DU.
+"""
+
+import contextlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+LOG = logging.getLogger(__name__)
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Responses which indicate the DU is overloaded and we should back off
+THROTTLE_STATUSES = (
+    429,  # Too Many Requests
+    500,  # Internal Server Error
+    502,  # Bad Gateway
+    503,  # Service Unavailable
+    504  # Gateway Timeout
+)
+
+# Shared state is group-writable so workers running as different users in
+# the same group can share it; the directory is setgid so new files inherit
+# its group
+SHARED_DIR_MODE = 0o2770
+SHARED_FILE_MODE = 0o660
+
+
+def _is_number(value):
+    return (isinstance(value, (int, float)) and not isinstance(value, bool) and
+            math.isfinite(value))
+
+
+class TokenBucket():
+    """
+    Thread-safe token bucket whose refill rate adapts to the responses it
+    is told about: additive increase on success, multiplicative decrease on
+    throttling responses, errors or slow responses (AIMD).
+    """
+
+    def __init__(self, rate, burst=None, min_rate=None, additive_increase=None,
+                 multiplicative_decrease=0.5, latency_threshold=None,
+                 decrease_interval=1.0):
+        """
+        :param rate: maximum (and initial) rate in requests per second
+        :param burst: bucket capacity, defaults to max(1, rate)
+        :param min_rate: floor for the adapted rate, defaults to rate / 10
+        :param additive_increase: requests per second added per successful
+               response, defaults to rate / 50
+        :param multiplicative_decrease: factor applied to the rate on back off
+        :param latency_threshold: responses slower than this many seconds are
+               treated as a back off signal; None disables the check
+        :param decrease_interval: minimum seconds between two decreases, so a
+               batch of concurrent failures only halves the rate once
+        """
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        if burst is not None and burst < 1:
+            raise ValueError('burst must be at least 1')
+        if min_rate is not None and not 0 < min_rate <= rate:
+            raise ValueError('min_rate must be positive and no greater than rate')
+        if not 0 < multiplicative_decrease < 1:
+            raise ValueError('multiplicative_decrease must be between 0 and 1')
+        if decrease_interval < 0:
+            raise ValueError('decrease_interval must not be negative')
+        self.max_rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, rate))
+        self.min_rate = float(min_rate if min_rate is not None else rate / 10.0)
+        self.additive_increase = float(additive_increase if additive_increase is not None
+                                       else rate / 50.0)
+        self.multiplicative_decrease = float(multiplicative_decrease)
+        self.latency_threshold = latency_threshold
+        self.decrease_interval = float(decrease_interval)
+        self._lock = threading.Lock()
+        self._state = self._initial_state()
+
+    @staticmethod
+    def _now():
+        return time.monotonic()
+
+    def _initial_state(self):
+        return {'rate': self.max_rate,
+                'tokens': self.burst,
+                'updated': self._now(),
+                'last_decrease': None}
+
+    @contextlib.contextmanager
+    def _locked_state(self):
+        with self._lock:
+            yield self._state
+
+    def _refill(self, state, now):
+        elapsed = max(0.0, now - state['updated'])
+        state['tokens'] = min(self.burst, state['tokens'] + elapsed * state['rate'])
+        state['updated'] = now
+
+    @property
+    def rate(self):
+        """
+        The current adapted rate in requests per second
+        """
+        with self._locked_state() as state:
+            return state['rate']
+
+    def acquire(self):
+        """
+        Block until a token is available and consume it
+        :return: the number of seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self._locked_state() as state:
+                self._refill(state, self._now())
+                if state['tokens'] >= 1.0:
+                    state['tokens'] -= 1.0
+                    return waited
+                delay = (1.0 - state['tokens']) / state['rate']
+            time.sleep(delay)
+            waited += delay
+
+    def record(self, status_code, latency):
+        """
+        Adapt the rate to the outcome of a request
+        :param status_code: HTTP status of the response, None if the request failed
+        :param latency: seconds the request took, None if unknown
+        :return:
+        """
+        backoff = (status_code is None or status_code in THROTTLE_STATUSES or
+                   (self.latency_threshold is not None and latency is not None and
+                    latency > self.latency_threshold))
+        with self._locked_state() as state:
+            now = self._now()
+            self._refill(state, now)
+            if backoff:
+                if (state['last_decrease'] is not None and
+                        now - state['last_decrease'] < self.decrease_interval):
+                    return
+                state['rate'] = max(self.min_rate,
+                                    state['rate'] * self.multiplicative_decrease)
+                state['tokens'] = min(state['tokens'], 1.0)
+                state['last_decrease'] = now
+                LOG.debug('Backing off to %.2f req/s (status: %s, latency: %s)',
+                          state['rate'], status_code, latency)
+            else:
+                state['rate'] = min(self.max_rate,
+                                    state['rate'] + self.additive_increase)
+
+
+class FileTokenBucket(TokenBucket):
+    """
+    TokenBucket whose state lives in a file guarded by flock(2), so that
+    every process on the host using the same path shares a single budget.
+    """
+
+    def __init__(self, path, rate, **kwargs):
+        if fcntl is None:
+            raise ValueError('file-backed rate limiting requires fcntl')
+        self.path = path
+        super().__init__(rate, **kwargs)
+
+    @staticmethod
+    def _now():
+        # Unlike the monotonic clock, wall time is comparable across processes
+        return time.time()
+
+    def _open(self):
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL,
+                         SHARED_FILE_MODE)
+            # The mode passed to os.open is masked by the umask
+            os.fchmod(fd, SHARED_FILE_MODE)
+        except FileExistsError:
+            fd = os.open(self.path, os.O_RDWR)
+        return os.fdopen(fd, 'r+')
+
+    def _parse_state(self, data):
+        state = json.loads(data)
+        if not (isinstance(state, dict) and
+                _is_number(state.get('rate')) and
+                _is_number(state.get('tokens')) and
+                _is_number(state.get('updated')) and
+                (state.get('last_decrease') is None or
+                 _is_number(state['last_decrease']))):
+            raise ValueError('invalid rate limiter state')
+        # Other processes may have been configured differently
+        return {'rate': min(self.max_rate, max(self.min_rate, state['rate'])),
+                'tokens': min(self.burst, state['tokens']),
+                'updated': state['updated'],
+                'last_decrease': state.get('last_decrease')}
+
+    @contextlib.contextmanager
+    def _locked_state(self):
+        with self._lock, self._open() as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            try:
+                state = self._parse_state(state_file.read())
+            except ValueError:
+                state = self._initial_state()
+            yield state
+            state_file.seek(0)
+            state_file.truncate()
+            state_file.write(json.dumps(state))
+            state_file.flush()
+
+
+class RateLimiter():
+    """
+    Rate limiter with separate budgets for read and write requests.
+    """
+
+    def __init__(self, read_rate=10.0, write_rate=2.0, shared_state_dir=None,
+                 **bucket_args):
+        """
+        :param read_rate: maximum GET/HEAD/OPTIONS requests per second
+        :param write_rate: maximum requests per second for other methods
+        :param shared_state_dir: optional directory in which to keep the
+               bucket state so that all processes pointing at it share it.
+               It is created group-writable and setgid if missing.
+        :param bucket_args: passed through to TokenBucket
+        """
+        if shared_state_dir:
+            if not os.path.isdir(shared_state_dir):
+                os.makedirs(shared_state_dir, exist_ok=True)
+                try:
+                    # The mode passed to os.makedirs is masked by the umask
+                    os.chmod(shared_state_dir, SHARED_DIR_MODE)
+                except PermissionError:
+                    # Created concurrently by a process running as another user
+                    pass
+            self.read_bucket = FileTokenBucket(
+                os.path.join(shared_state_dir, 'qbertclient-read.json'),
+                read_rate, **bucket_args)
+            self.write_bucket = FileTokenBucket(
+                os.path.join(shared_state_dir, 'qbertclient-write.json'),
+                write_rate, **bucket_args)
+        else:
+            self.read_bucket = TokenBucket(read_rate, **bucket_args)
+            self.write_bucket = TokenBucket(write_rate, **bucket_args)
+
+    def bucket_for(self, method):
+        """
+        Return the bucket that requests using method draw from
+        :param method: HTTP method
+        :return: TokenBucket
+        """
+        if method.upper() in READ_METHODS:
+            return self.read_bucket
+        return self.write_bucket
+
+    def acquire(self, method):
+        """
+        Block until a request using method may be sent
+        :param method: HTTP method
+        :return: the number of seconds spent waiting
+        """
+        return self.bucket_for(method).acquire()
+
+    def record(self, method, status_code, latency):
+        """
+        Report the outcome of a request using method
+        :param method: HTTP method
+        :param status_code: HTTP status of the response, None if the request failed
+        :param latency: seconds the request took, None if unknown
+        :return:
+        """
+        self.bucket_for(method).record(status_code, latency)
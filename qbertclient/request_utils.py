@@ -18,6 +18,8 @@ This module implements a few helpful methods for interfacing with the requests l
 
 import logging
 import os
+import threading
+import time
 
 from requests import Session
 from requests.adapters import HTTPAdapter
@@ -27,12 +29,59 @@ from qbertclient import exceptions as QbertExceptions
 LOG = logging.getLogger(__name__)
 REQUEST_TIMEOUT = int(os.getenv('HTTP_REQUEST_TIMEOUT_IN_SECS', '180'))
 
+# Start time of the attempt currently in flight on this thread, used to
+# report per-attempt latency to the rate limiter
+_ATTEMPT = threading.local()
 
-def session_with_retries(host, max_retries=10):
+
+def _start_attempt():
+    _ATTEMPT.start = time.monotonic()
+
+
+def _attempt_latency():
+    start = getattr(_ATTEMPT, 'start', None)
+    return None if start is None else time.monotonic() - start
+
+
+class RateLimitedRetry(Retry):
+    """
+    Retry policy which reports every failed attempt to a rate limiter and
+    waits for a token from it before each retry goes out.
+    """
+
+    def __init__(self, *args, rate_limiter=None, **kwargs):
+        self.rate_limiter = rate_limiter
+        self._method = None
+        super().__init__(*args, **kwargs)
+
+    def new(self, **kw):
+        kw.setdefault('rate_limiter', self.rate_limiter)
+        return super().new(**kw)
+
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        if self.rate_limiter is not None and method is not None:
+            status = response.status if response is not None else None
+            self.rate_limiter.record(method, status, _attempt_latency())
+        new_retry = super().increment(method, url, response, error,
+                                      _pool, _stacktrace)
+        new_retry._method = method
+        return new_retry
+
+    def sleep(self, response=None):
+        super().sleep(response)
+        if self.rate_limiter is not None and self._method is not None:
+            self.rate_limiter.acquire(self._method)
+            _start_attempt()
+
+
+def session_with_retries(host, max_retries=10, rate_limiter=None):
     """
     Return a session with retries
     :param host:
     :param max_retries:
+    :param rate_limiter: optional rate_limit.RateLimiter which every attempt,
+           including retries, is throttled through and reported to
     :return:
     """
     session = Session()
@@ -41,25 +90,38 @@ def session_with_retries(host, max_retries=10):
         503,  # Service Unavailable
         504  # Gateway Timeout
     ]
-    retries = Retry(total=max_retries, backoff_factor=1.0,
-                    status_forcelist=http_statuses_to_retry)
+    if rate_limiter is not None:
+        retries = RateLimitedRetry(total=max_retries, backoff_factor=1.0,
+                                   status_forcelist=http_statuses_to_retry,
+                                   rate_limiter=rate_limiter)
+    else:
+        retries = Retry(total=max_retries, backoff_factor=1.0,
+                        status_forcelist=http_statuses_to_retry)
     # HTTPAdapter's `max_retries` takes either an integer, or Retry object
     session.mount(host, HTTPAdapter(max_retries=retries))
     return session
 
 
-def make_req(session, endpoint, method, body, **kwargs):
+def make_req(session, endpoint, method, body, rate_limiter=None, **kwargs):
     """
     Main request wrapper
     :param session:
     :param endpoint:
     :param method:
     :param body:
+    :param rate_limiter: optional rate_limit.RateLimiter to throttle through.
+           Failed attempts are reported by the session's retry policy, so
+           this should be the limiter the session was created with.
     :param kwargs:
     :return:
     """
+    if rate_limiter is not None:
+        rate_limiter.acquire(method)
+    _start_attempt()
     resp = session.request(method, endpoint, json=body,
                            timeout=REQUEST_TIMEOUT, **kwargs)
+    if rate_limiter is not None:
+        rate_limiter.record(method, resp.status_code, _attempt_latency())
     LOG.debug('%s %s - %s', method, endpoint, resp.status_code)
     if 'application/json' in resp.headers.get('content-type'):
         obj = resp.json()
@@ -0,0 +1,275 @@
+#  Copyright 2019 Platform9
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+Tests for the rate_limit module and its use in request_utils and Qbert.
+"""
+
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+
+from qbertclient import qbert, rate_limit, request_utils
+
+
+class FakeClockMixin():
+    """
+    Replace a bucket's clock with one the test controls.
+    """
+
+    def use_fake_clock(self, bucket):
+        self.now = 1000.0
+        bucket._now = lambda: self.now
+        with bucket._locked_state() as state:
+            state['updated'] = self.now
+
+
+class TokenBucketTest(FakeClockMixin, unittest.TestCase):
+
+    def test_invalid_arguments(self):
+        for kwargs in ({'rate': 0},
+                       {'rate': 5, 'burst': 0.5},
+                       {'rate': 5, 'min_rate': 0},
+                       {'rate': 5, 'min_rate': -1},
+                       {'rate': 5, 'min_rate': 20},
+                       {'rate': 5, 'multiplicative_decrease': 1},
+                       {'rate': 5, 'decrease_interval': -1}):
+            with self.assertRaises(ValueError, msg=kwargs):
+                rate_limit.TokenBucket(**kwargs)
+
+    def test_min_rate_may_equal_rate(self):
+        bucket = rate_limit.TokenBucket(5, min_rate=5)
+        bucket.record(503, 0.1)
+        self.assertEqual(bucket.rate, 5.0)
+
+    def test_acquire_consumes_burst_then_blocks(self):
+        bucket = rate_limit.TokenBucket(20, burst=5)
+        start = time.monotonic()
+        for _ in range(5):
+            self.assertEqual(bucket.acquire(), 0.0)
+        self.assertLess(time.monotonic() - start, 0.05)
+        waited = bucket.acquire()
+        self.assertGreater(waited, 0.0)
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+
+    def test_refill_is_capped_at_burst(self):
+        bucket = rate_limit.TokenBucket(10, burst=3)
+        self.use_fake_clock(bucket)
+        for _ in range(3):
+            bucket.acquire()
+        self.now += 0.2
+        with bucket._locked_state() as state:
+            bucket._refill(state, self.now)
+            self.assertAlmostEqual(state['tokens'], 2.0)
+        self.now += 100
+        with bucket._locked_state() as state:
+            bucket._refill(state, self.now)
+            self.assertEqual(state['tokens'], 3.0)
+
+    def test_record_halves_rate_on_backoff_signals(self):
+        for status, latency in ((429, 0.1), (500, 0.1), (503, 0.1),
+                                (None, 0.1), (200, 5.0)):
+            bucket = rate_limit.TokenBucket(8, latency_threshold=1.0)
+            bucket.record(status, latency)
+            self.assertEqual(bucket.rate, 4.0, (status, latency))
+
+    def test_record_ignores_unknown_latency(self):
+        bucket = rate_limit.TokenBucket(8, latency_threshold=1.0)
+        bucket.record(200, None)
+        self.assertEqual(bucket.rate, 8.0)
+
+    def test_record_decreases_once_per_interval(self):
+        bucket = rate_limit.TokenBucket(8, decrease_interval=1.0)
+        self.use_fake_clock(bucket)
+        bucket.record(503, 0.1)
+        bucket.record(503, 0.1)
+        self.assertEqual(bucket.rate, 4.0)
+        self.now += 1.0
+        bucket.record(503, 0.1)
+        self.assertEqual(bucket.rate, 2.0)
+
+    def test_record_does_not_go_below_min_rate(self):
+        bucket = rate_limit.TokenBucket(8, min_rate=3, decrease_interval=0)
+        for _ in range(5):
+            bucket.record(503, 0.1)
+        self.assertEqual(bucket.rate, 3.0)
+
+    def test_record_recovers_additively_up_to_max_rate(self):
+        bucket = rate_limit.TokenBucket(8, additive_increase=1.0)
+        bucket.record(503, 0.1)
+        bucket.record(200, 0.1)
+        self.assertEqual(bucket.rate, 5.0)
+        for _ in range(10):
+            bucket.record(200, 0.1)
+        self.assertEqual(bucket.rate, 8.0)
+
+
+class FileTokenBucketTest(FakeClockMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.state_dir)
+        self.path = os.path.join(self.state_dir, 'bucket.json')
+
+    def test_instances_share_budget(self):
+        first = rate_limit.FileTokenBucket(self.path, 10, burst=4)
+        second = rate_limit.FileTokenBucket(self.path, 10, burst=4)
+        self.use_fake_clock(first)
+        second._now = first._now
+        for bucket in (first, second, first, second):
+            bucket.acquire()
+        with second._locked_state() as state:
+            self.assertAlmostEqual(state['tokens'], 0.0)
+
+    def test_instances_share_adapted_rate(self):
+        first = rate_limit.FileTokenBucket(self.path, 10)
+        second = rate_limit.FileTokenBucket(self.path, 10)
+        first.record(503, 0.1)
+        self.assertEqual(second.rate, 5.0)
+        # The decrease interval is shared as well
+        second.record(503, 0.1)
+        self.assertEqual(first.rate, 5.0)
+
+    def test_invalid_state_is_reset(self):
+        bucket = rate_limit.FileTokenBucket(self.path, 10)
+        valid = {'rate': 4.0, 'tokens': 1.0, 'updated': time.time(),
+                 'last_decrease': None}
+        for state in ('not json', '[]',
+                      dict(valid, updated=None),
+                      dict(valid, last_decrease='yesterday'),
+                      dict(valid, tokens=True),
+                      {'rate': 4.0, 'tokens': 1.0}):
+            with open(self.path, 'w') as state_file:
+                state_file.write(state if isinstance(state, str) else json.dumps(state))
+            bucket.acquire()
+            bucket.record(503, 0.1)
+            self.assertEqual(bucket.rate, 5.0, state)
+
+    def test_state_file_is_group_writable(self):
+        old_umask = os.umask(0o022)
+        self.addCleanup(os.umask, old_umask)
+        rate_limit.FileTokenBucket(self.path, 10).acquire()
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o660)
+
+    def test_rate_limiter_creates_state_dir(self):
+        state_dir = os.path.join(self.state_dir, 'missing', 'dir')
+        limiter = rate_limit.RateLimiter(shared_state_dir=state_dir)
+        limiter.acquire('GET')
+        limiter.acquire('POST')
+        self.assertEqual(stat.S_IMODE(os.stat(state_dir).st_mode), 0o2770)
+        self.assertTrue(os.path.exists(os.path.join(state_dir, 'qbertclient-read.json')))
+        self.assertTrue(os.path.exists(os.path.join(state_dir, 'qbertclient-write.json')))
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_bucket_for(self):
+        limiter = rate_limit.RateLimiter(read_rate=10, write_rate=2)
+        for method in ('GET', 'get', 'HEAD', 'OPTIONS'):
+            self.assertIs(limiter.bucket_for(method), limiter.read_bucket)
+        for method in ('POST', 'PUT', 'PATCH', 'DELETE'):
+            self.assertIs(limiter.bucket_for(method), limiter.write_bucket)
+        self.assertEqual(limiter.read_bucket.rate, 10.0)
+        self.assertEqual(limiter.write_bucket.rate, 2.0)
+
+    def test_record_only_affects_matching_bucket(self):
+        limiter = rate_limit.RateLimiter(read_rate=10, write_rate=2)
+        limiter.record('POST', 503, 0.1)
+        self.assertEqual(limiter.read_bucket.rate, 10.0)
+        self.assertEqual(limiter.write_bucket.rate, 1.0)
+
+
+class RecordingLimiter(rate_limit.RateLimiter):
+    """
+    RateLimiter which remembers every acquire and record call.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.calls = []
+
+    def acquire(self, method):
+        self.calls.append(('acquire', method))
+        return super().acquire(method)
+
+    def record(self, method, status_code, latency):
+        self.calls.append(('record', method, status_code))
+        super().record(method, status_code, latency)
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    """
+    Answer every request with the server's configured status.
+    """
+
+    def do_GET(self):
+        self.server.requests += 1
+        self.send_response(self.server.status)
+        self.send_header('Content-Type', 'application/json')
+        body = b'{"clusters": []}'
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class RequestPathTest(unittest.TestCase):
+
+    def start_server(self, status):
+        server = HTTPServer(('127.0.0.1', 0), StatusHandler)
+        server.status = status
+        server.requests = 0
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server, 'http://127.0.0.1:{}'.format(server.server_port)
+
+    def test_every_retry_goes_through_limiter(self):
+        server, url = self.start_server(503)
+        limiter = RecordingLimiter(read_rate=10)
+        session = request_utils.session_with_retries(url, max_retries=1,
+                                                     rate_limiter=limiter)
+        with self.assertRaises(requests.exceptions.RetryError):
+            request_utils.make_req(session, url + '/clusters', 'GET', {},
+                                   rate_limiter=limiter)
+        self.assertEqual(server.requests, 2)
+        self.assertEqual(limiter.calls, [('acquire', 'GET'),
+                                         ('record', 'GET', 503),
+                                         ('acquire', 'GET'),
+                                         ('record', 'GET', 503)])
+        self.assertEqual(limiter.read_bucket.rate, 5.0)
+
+    def test_qbert_reports_successful_requests(self):
+        server, url = self.start_server(200)
+        limiter = RecordingLimiter(read_rate=10)
+        qb = qbert.Qbert('token', url, rate_limiter=limiter)
+        qb.list_clusters()
+        self.assertEqual(server.requests, 1)
+        self.assertEqual(limiter.calls, [('acquire', 'GET'),
+                                         ('record', 'GET', 200)])
+
+
+if __name__ == '__main__':
+    unittest.main()